@@ -3,33 +3,32 @@ Finds the volume measurement from the preds output of a model.
 """
 import pathlib
 
-import common.dictutils
-import common.files as files
 import analysis.volume as vol
+import common.files as files
 
 preds = pathlib.Path('data/iwfs_out/')
 
 
 def main():
-    preds_series = files.read_image_series(preds, ends_with="pred.png")
-    preds_series = common.dictutils.slices_to_mask(preds_series, threshold=0.5)
-    preds_volumes = common.dictutils.visit_to_volume(preds_series)
+    # One streaming pass: each slice is thresholded and counted as soon as it is decoded, and never kept
+    slice_counts = {}  # {patient: {visit: {slice_id: voxel count} } }
+    for (patient, visit, slice_id), im in files.iter_image_series(preds, ends_with="pred.png"):
+        slice_counts.setdefault(patient, {}).setdefault(visit, {})[slice_id] = vol.mask(im, threshold=0.5)
 
     print("Volumetric Analysis")
 
-    for patient, visits in preds_volumes.items():
-        for visit, volume in visits.items():
-            v = vol.mask(volume, voxel_size=0.357 * 0.511 * 3)
+    for patient, visits in slice_counts.items():
+        for visit, counts in visits.items():
+            v = vol.VOXEL_IWFS * sum(counts.values())
             print(f"{patient}, {visit}: {v: .3f} mm^3.")
 
     print("Per-Slice Analysis")
 
-    for patient, visits in preds_series.items():
-        for visit, slice_ids in visits.items():
+    for patient, visits in slice_counts.items():
+        for visit, counts in visits.items():
             print(f"== {patient} {visit} ==")
-            for slice_id, im in slice_ids.items():
-                v = vol.mask(im, voxel_size=0.357 * 0.511 * 3)
-                print(f"  {slice_id}: {v: .3f} mm^3")
+            for slice_id, count in counts.items():
+                print(f"  {slice_id}: {vol.VOXEL_IWFS * count: .3f} mm^3")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,21 @@
+import numpy as np
+import scipy.special
+
+
+def pearson(x, y):
+    """
+    Calculates the Pearson correlation coefficient of two samples, and its two-sided p-value.
+    Same result as scipy.stats.pearsonr, without importing scipy.stats.
+    :param x: np.ndarray, first sample (1D)
+    :param y: np.ndarray, second sample (1D), same length as x
+    :return: (r, p-value)
+    """
+    assert x.ndim == 1 and x.shape == y.shape, "Samples should be 1D and of equal length."
+    n = x.shape[0]
+    assert n >= 2, "Need at least two samples to correlate."
+
+    r = np.clip(np.corrcoef(x, y)[0, 1], -1.0, 1.0)
+    # Under the null hypothesis, (r + 1) / 2 follows a Beta(n/2 - 1, n/2 - 1) distribution
+    ab = n / 2 - 1
+    p_val = 2 * scipy.special.betainc(ab, ab, 0.5 * (1 - abs(r))) if n > 2 else 1.0
+    return r, p_val
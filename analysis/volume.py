@@ -1,15 +1,157 @@
+import functools
+import io
+import os
+
 import numpy as np
 
+import common.files as files
+
+# Voxel sizes (mm^3) of each acquisition: in-plane spacing * slice thickness
+VOXEL_IWFS = 0.357 * 0.511 * 3
+VOXEL_DESS = 0.365 * 0.456 * 0.7
+VOXEL_BML = VOXEL_IWFS  # BML masks are drawn on the IWFS scans
+
+# Files at most this large are mostly blank predictions, and those encode to the same few bytes every time
+_SMALL_IMAGE_BYTES = 1024
 
-def mask(arr, voxel_size=1):
+
+def mask(arr, voxel_size=1, threshold=None):
     """
     Calculates the volume of a slice (or series) based on a voxel size.
-    :param arr: np.ndarray of type bool
+    :param arr: np.ndarray of type bool, or of image data if a threshold is given
     :param voxel_size: Size of a voxel, in your unit of choice
+    :param threshold: Optional, threshold for a voxel of image data to count towards the volume
     :return: Single value, total volume (slice or volume-wise)
     """
     assert type(arr) is np.ndarray, "Array must be an n-dimensional numpy array."
-    assert arr.dtype == np.bool or arr.dtype == bool, f"Array must contain boolean values."
+    assert threshold is not None or arr.dtype == np.bool or arr.dtype == bool, f"Array must contain boolean values."
     assert arr.ndim == 2 or arr.ndim == 3, "Array should be (slice * ) row * column."
+    return voxel_size * _count(arr, threshold)
+
+
+def _count(arr, threshold=None):
+    """
+    Counts the voxels of a slice (or series) which are True, or above the threshold if one is given.
+    :param arr: np.ndarray of type bool, or of image data if a threshold is given
+    :param threshold: Optional, threshold for a voxel of image data to count
+    :return: int, number of voxels
+    """
+    if threshold is None or (arr.dtype == np.uint8 and 0 <= threshold < 1):
+        # For uint8 data (ex. 0/255 masks), any threshold in [0, 1) is just "nonzero"
+        return np.count_nonzero(arr)
+
+    # Threshold and count one slice at a time, so the boolean temporary stays in cache
+    count = 0
+    for slc in arr.reshape(-1, *arr.shape[-2:]):
+        count += np.count_nonzero(slc > threshold)
+    return count
+
+
+def _count_file(path, threshold=None, memo=None):
+    """
+    Decodes an image file and counts its voxels, see _count.
+    Small files are counted once per distinct content, so repeated blank slices skip the decode entirely.
+    :param path: pathlib.Path, path to the image
+    :param threshold: Optional, threshold for a voxel of image data to count
+    :param memo: Optional, dict {file bytes: voxel count} of small files already counted (with this threshold)
+    :return: int, number of voxels
+    """
+    if memo is None or os.stat(path).st_size > _SMALL_IMAGE_BYTES:
+        return _count(files.read_image(path, writable=False), threshold)
+
+    data = path.read_bytes()
+    count = memo.get(data)
+    if count is None:
+        count = _count(files.read_image(io.BytesIO(data), writable=False), threshold)
+        memo[data] = count
+    return count
+
+
+def series_to_volumes(nested_dict, voxel_size=1, threshold=0.5):
+    """
+    Calculates the volume of every visit in a series, in one pass over the image data.
+    Each visit is thresholded and counted with mask, without keeping a thresholded copy.
+    :param nested_dict: Typical nested dict, ex. parsed by common.files.read_image_series,
+                        or {patient: {visit: 3D Array} }, ex. parsed by common.files.read_image_volumes
+    :param voxel_size: Size of a voxel, in your unit of choice
+    :param threshold: Threshold for a voxel to count towards the volume
+    :return: Nested dictionary {patient: {visit: volume} }
+    """
+    assert type(nested_dict) is dict, "Expecting dictionary as input."
+    result = {}
+
+    for patient, visits in nested_dict.items():
+        for visit, slice_ids in visits.items():
+            if isinstance(slice_ids, np.ndarray):  # Already stacked into a volume
+                stacked = slice_ids
+            else:
+                stacked = np.stack(list(slice_ids.values()))
+            result.setdefault(patient, {})[visit] = mask(stacked, voxel_size=voxel_size, threshold=threshold)
 
-    return np.multiply(voxel_size, np.count_nonzero(arr))
+    return result
+
+
+def read_volumes(path, ends_with="pred.png", voxel_size=1, threshold=0.5, no_visit=False):
+    """
+    Reads image files in series, and calculates the volume of every visit in one streaming pass.
+    Each slice is thresholded and counted on the decoding threads, so no mask or volume is ever stored.
+    Same result as common.files.read_image_volumes -> series_to_volumes.
+    :param path: Path to folder containing the images, see common.files.read_image_series for the naming format
+    :param ends_with: String ending of filename (before ending) to match
+    :param voxel_size: Size of a voxel, in your unit of choice
+    :param threshold: Threshold for a voxel to count towards the volume
+    :param no_visit: If the filenames don't have v01, etc.
+    :return: Nested dictionary {patient: {visit: volume} }
+    """
+    counts = {}
+    # Only kept for this call, so the small files' contents are released once the counts are done
+    reader = functools.partial(_count_file, threshold=threshold, memo={})
+    for (patient, visit, _), count in files.iter_image_series(path, ends_with=ends_with, no_visit=no_visit,
+                                                              reader=reader):
+        visits = counts.setdefault(patient, {})
+        visits[visit] = visits.get(visit, 0) + count
+
+    return {patient: {visit: voxel_size * count for visit, count in visits.items()}
+            for patient, visits in counts.items()}
+
+
+def first_visits(nested_dict):
+    """
+    Flattens volumes into parallel arrays of patients and the volume of each patient's first visit.
+    Sorted by patient, so datasets can be aligned with np.intersect1d(..., return_indices=True).
+    :param nested_dict: Nested dictionary {patient: {visit: volume} }, ex. from read_volumes
+    :return: (np.ndarray of patients, np.ndarray of first visit volumes)
+    """
+    patients = sorted(nested_dict)
+    volumes = np.fromiter((next(iter(nested_dict[patient].values())) for patient in patients),
+                          dtype=np.float64, count=len(patients))
+    return np.array(patients, dtype=np.int64), volumes
+
+
+def align_patients(patients_a, patients_b):
+    """
+    Matches two sorted, unique patient arrays (ex. from first_visits) in one pass.
+    :param patients_a: np.ndarray of patients
+    :param patients_b: np.ndarray of patients
+    :return: (common patients, their indices in a, their indices in b, patients only in a, patients only in b)
+    """
+    common, i_a, i_b = np.intersect1d(patients_a, patients_b, assume_unique=True, return_indices=True)
+    only_a = np.ones(len(patients_a), dtype=bool)
+    only_a[i_a] = False
+    only_b = np.ones(len(patients_b), dtype=bool)
+    only_b[i_b] = False
+    return common, i_a, i_b, patients_a[only_a], patients_b[only_b]
+
+
+def load_volumes(path, ends_with="pred.png", voxel_size=1, no_visit=False):
+    """
+    Loads a folder of image series as the volume of each patient's first visit, as the analysis scripts use them.
+    Same as read_volumes (with a threshold of 0.5) -> first_visits.
+    :param path: Path to folder containing the images, see common.files.read_image_series for the naming format
+    :param ends_with: String ending of filename (before ending) to match
+    :param voxel_size: Size of a voxel, in your unit of choice
+    :param no_visit: If the filenames don't have v01, etc.
+    :return: (np.ndarray of patients, np.ndarray of first visit volumes)
+    """
+    return first_visits(read_volumes(path, ends_with=ends_with, voxel_size=voxel_size, threshold=0.5,
+                                     no_visit=no_visit))
@@ -1,7 +1,6 @@
 import collections
 from typing import Union
 
-import numpy as np
 from pydicom import Dataset
 
 
@@ -15,7 +14,8 @@ def update_nested_dict(original: dict, update: Union[dict, collections.abc.Mappi
     # Iterate over each current-level item
     for k, v in update.items():
         # If the value is a Mapping, it's a next level which should be handled recursively
-        if isinstance(v, collections.abc.Mapping) and not isinstance(v, Dataset):
+        # (plain dicts are checked first, since the ABC isinstance check is comparatively slow)
+        if type(v) is dict or (isinstance(v, collections.abc.Mapping) and not isinstance(v, Dataset)):
             original[k] = update_nested_dict(original.get(k, {}), v)
         # Otherwise, it's the end of a recursive tree
         else:
@@ -24,54 +24,10 @@ def update_nested_dict(original: dict, update: Union[dict, collections.abc.Mappi
 
 
 def find_diff(i1, i2):
-    i2_missing = []
-    i1_missing = []
-
-    for item in i1:
-        if item not in i2:
-            i2_missing.append(item)
-
-    for item in i2:
-        if item not in i1:
-            i1_missing.append(item)
+    # Hash each side once, so each membership test is O(1); the filters keep the input order
+    s1 = set(i1)
+    s2 = set(i2)
+    i2_missing = [item for item in i1 if item not in s2]
+    i1_missing = [item for item in i2 if item not in s1]
 
     return i1_missing, i2_missing
-
-
-def slices_to_mask(nested_dict: dict, threshold=0.5):
-    """
-    Converts image data to boolean. Rounds if neccessary.
-    Note: expects typical nested dict! NOT modified to be volumes, etc.
-    :param threshold: Threshold for True value
-    :param nested_dict: Typical nested dict, ex. parsed by common.files.read_bmp_series
-    :return: Updated version of the dict
-    """
-    assert type(nested_dict) is dict, "Expecting dictionary as input."
-    result = {}
-
-    for patient, visits in nested_dict.items():
-        for visit, slice_ids in visits.items():
-            for slice_id, im in slice_ids.items():
-                new_im = (im > threshold)
-                update_nested_dict(result, {patient: {visit: {slice_id: new_im}}})
-    return result
-
-
-def visit_to_volume(nested_dict: dict):
-    """
-    Converts nested dict of {patient: {visit: {slice_id: image} } } to {patient: {visit: 3D Array } }
-    :param nested_dict: Typical nested dict, ex. parsed by common.files.read_bmp_series
-    :return: Updated version of the dict
-    """
-    assert type(nested_dict) is dict, "Expecting dictionary as input."
-    result = {}
-
-    for patient, visits in nested_dict.items():
-        for visit, slice_ids in visits.items():
-            visit_volume = []
-            for slice_id, im in slice_ids.items():
-                visit_volume.append(im)
-            visit_volume = np.array(visit_volume)
-            update_nested_dict(result, {patient: {visit: visit_volume}})
-
-    return result
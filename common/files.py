@@ -1,9 +1,13 @@
 from PIL import Image
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import collections
+import functools
 import pydicom
 import pathlib
 import logging
+import os
+import struct
 import numpy as np
-import common.dictutils as du
 import common.masks as mask_generator
 import sys
 
@@ -20,7 +24,14 @@ def _rescale(data):
     :param data: Data to convert and rescale
     :return: Rescaled data
     """
-    arr = data / np.max(data)
+    peak = np.max(data)
+    if data.dtype.kind == 'u' and data.dtype.itemsize <= 2 and peak > 0:
+        # Same steps in exact integer math, for unsigned data (DICOM pixels are usually uint16):
+        # 255 * data fits in uint32, and floor division matches the truncating cast to uint8.
+        arr = np.multiply(data, 255, dtype=np.uint32)
+        np.floor_divide(arr, peak, out=arr)
+        return arr.astype(np.uint8)
+    arr = data / peak
     arr = 255 * arr
     arr = arr.astype(np.uint8)
     return arr
@@ -34,35 +45,22 @@ def _resize(data, size=(448, 448), center=False):
     :param center: boolean, whether to use centering methods.
     :return: Resized data
     """
-    if center:  # Use image centering to add padding equally to each side
-        if data.shape != size:  # If specified size is different...
-            if data.shape[0] > size[0]:  # If dim 0 is bigger than specified, trim it
-                x_start = data.shape[0] // 2 - size[0] // 2
-                x_end = x_start + size[0]
-                data = data[x_start:x_end]
-            else:  # Else, if it's the same or lesser, pad it
-                diff = size[0] - data.shape[0]
-                data = np.pad(data, [(diff//2, diff - (diff//2)), (0, 0)])
-            if data.shape[1] > size[1]:  # If dim 1 is bigger than specified, trim it
-                y_start = data.shape[1] // 2 - size[1] // 2
-                y_end = y_start + size[1]
-                data = data[:, y_start:y_end]
-            else:  # Else, if it's the same or lesser, pad it
-                diff = size[1] - data.shape[1]
-                data = np.pad(data, [(0, 0), (diff // 2, diff - (diff // 2))])
-
-    else:  # Just align the image to the top left and pad the bottom and right
-        top = 0
-        bottom = size[1] - data.shape[1]
-        left = 0
-        right = size[0] - data.shape[0]
-        if bottom < 0:
-            data = data[:, :size[1]]
-            bottom = 0
-        if right < 0:
-            data = data[:size[0], :]
-            right = 0
-        data = np.pad(data, ((left, right), (top, bottom)))
+    # Work out the crop and the padding for each axis first, then apply each at most once
+    crop = []
+    pad = []
+    for length, desired in zip(data.shape, size):
+        if length > desired:  # If this dim is bigger than specified, trim it
+            start = length // 2 - desired // 2 if center else 0
+            crop.append(slice(start, start + desired))
+            pad.append((0, 0))
+        else:  # Else, if it's the same or lesser, pad it (equally to each side if centering, else bottom/right)
+            diff = desired - length
+            crop.append(slice(None))
+            pad.append((diff // 2, diff - (diff // 2)) if center else (0, diff))
+
+    data = data[tuple(crop)]
+    if any(before or after for before, after in pad):
+        data = np.pad(data, pad)
 
     assert data.shape == size, f"Error in logic! Shape was supposed to be {size}, but was {data.shape}"
     return data
@@ -111,8 +109,10 @@ def read_masks_from_txt(path):
     # This goes through the .txt, line by line and parses metadata first, then each segmented region.
     # The file format is proprietary. See masks.py for info about the structure.
 
-    file = open(path, 'r')
-    file_lines = file.readlines()
+    # A deque, as the parsers consume lines from the front (O(1) popleft, rather than O(n) list.pop(0))
+    # Every line is stripped once here, so the parsers can compare them directly
+    with open(path, 'r') as file:
+        file_lines = collections.deque(line.strip() for line in file)
     metadata = mask_generator.extract_mask_metadata(file_lines)
     slices = []
 
@@ -147,10 +147,78 @@ def write_mask(data, path, size=(448, 448)):
     :return: None
     """
     arr = _resize(data, size)
+    if arr.dtype == np.uint8 and str(path).lower().endswith('.bmp'):
+        _write_gray_bmp(arr, path)  # Same bytes PIL would write, without its per-file encoder setup
+        return
     im = Image.fromarray(arr, mode='L')
     im.save(path)
 
 
+# 256 entry grayscale palette (B, G, R, reserved) of an 8-bit BMP, as PIL writes it for mode 'L'
+_BMP_GRAY_PALETTE = b"".join(bytes((i, i, i, 0)) for i in range(256))
+
+
+def _write_gray_bmp(arr, path):
+    """
+    Writes a 2D uint8 array as an 8-bit grayscale BMP file, byte for byte identical to PIL's mode 'L' output.
+    :param arr: np.ndarray, (rows, columns) uint8 image data
+    :param path: pathlib.Path or str path to write the .bmp
+    :return: None
+    """
+    height, width = arr.shape
+    stride = (width + 3) & ~3  # Each row is padded to a multiple of 4 bytes
+    offset = 14 + 40 + len(_BMP_GRAY_PALETTE)
+    header = struct.pack('<2sIII' 'IIIHHIIIIII',
+                         b'BM', offset + stride * height, 0, offset,  # File header
+                         40, width, height, 1, 8, 0, stride * height, 3780, 3780, 256, 256)  # Info header (96 dpi)
+    rows = arr[::-1]  # BMP rows are stored bottom-up
+    if stride != width:
+        rows = np.pad(rows, [(0, 0), (0, stride - width)])
+    with open(path, 'wb') as file:
+        file.write(header)
+        file.write(_BMP_GRAY_PALETTE)
+        file.write(rows.tobytes())
+
+
+def read_image(path, writable=True):
+    """
+    Decodes a single image file into a pixel data array, in its native dtype (no upcast).
+    :param path: pathlib.Path or str, path to the image (or a binary file object)
+    :param writable: If False, returns a read-only view of the decoded buffer instead, which skips a copy
+    :return: np.ndarray of the pixel data
+    """
+    if writable:
+        return np.array(Image.open(path))
+    im = np.asarray(Image.open(path))
+    if not im.flags.c_contiguous:
+        im = np.ascontiguousarray(im)
+    return im
+
+
+def _list_and_parse(path, ends_with, no_visit):
+    """
+    Lists the image files of a series and parses their names, see read_image_series for the format.
+    :param path: str, path to folder containing the images
+    :param ends_with: String ending of filename (before ending) to match
+    :param no_visit: If the filenames don't have v01, etc.
+    :return: list of (pathlib.Path, (patient, visit, slice_id)) for each conforming file
+    """
+    listing = []
+    for file in pathlib.Path(path).glob(f"*{ends_with}"):
+        name_split = file.name[:-1 * len(ends_with)].split('_')[:-1]  # Ignore .bmp, store contents between underscores
+        if (no_visit is False and len(name_split) != 3) or (no_visit is True and len(name_split) != 2):
+            log.warning(f'File "{file.name}" does not conform to the naming standard.')
+            continue
+        if no_visit:
+            (patient, visit, slice_id) = int(name_split[0]), 'v00', int(name_split[1])
+        else:
+            (patient, visit, slice_id) = name_split
+            patient = int(patient)
+            slice_id = int(slice_id)
+        listing.append((file, (patient, visit, slice_id)))
+    return listing
+
+
 def read_image_series(path, ends_with="pred.png", no_visit=False):
     """
     Reads image files in series, following name format:
@@ -163,24 +231,83 @@ def read_image_series(path, ends_with="pred.png", no_visit=False):
     """
     result = {}
     folder = pathlib.Path(path)
-    files = list(folder.glob(f"*{ends_with}"))
-    if len(files) < 1:
+    listing = _list_and_parse(str(folder), ends_with, no_visit)
+    if len(listing) < 1:
         log.error(f"No images (ending in '{ends_with}') found in {folder}!")
         exit(-1)
 
-    for idx, file in enumerate(files):
-        name_split = file.name[:-1 * len(ends_with)].split('_')[:-1]  # Ignore .bmp, store contents between underscores
-        if (no_visit is False and len(name_split) != 3) or (no_visit is True and len(name_split) != 2):
-            log.warning(f'File "{file.name}" does not conform to the naming standard.')
-            continue
-        if no_visit:
-            (patient, visit, slice_id) = int(name_split[0]), 'v00', int(name_split[1])
-        else:
-            (patient, visit, slice_id) = name_split
-            patient = int(patient)
-            slice_id = int(slice_id)
-        im = np.array(Image.open(file))
-        du.update_nested_dict(result, {patient: {visit: {slice_id: im}}})
+    # PIL releases the GIL while decoding, so a thread pool scales with the number of cores
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        images = executor.map(read_image, [file for file, _ in listing])
+        for (_, (patient, visit, slice_id)), im in zip(listing, images):
+            result.setdefault(patient, {}).setdefault(visit, {})[slice_id] = im
+
+    return result
+
+
+def iter_image_series(path, ends_with="pred.png", no_visit=False, reader=None):
+    """
+    Decodes image files in series (see read_image_series for the naming format) one at a time, in listing order.
+    Decoding runs ahead on a thread pool, but only a few images are held in memory at once.
+    :param no_visit: If the filenames don't have v01, etc.
+    :param ends_with: String ending of filename (before ending) to match
+    :param path: Path to folder containing .bmps
+    :param reader: Optional, function run on each file's path on the thread pool, in place of decoding it
+    :return: Generator of ((patient, visit, slice_id), image), or of ((patient, visit, slice_id), reader(path))
+    """
+    folder = pathlib.Path(path)
+    listing = _list_and_parse(str(folder), ends_with, no_visit)
+    if len(listing) < 1:
+        log.error(f"No images (ending in '{ends_with}') found in {folder}!")
+        exit(-1)
+
+    reader = reader or read_image
+    workers = os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()  # Images being decoded ahead of the consumer, oldest first
+        for file, key in listing:
+            pending.append((key, executor.submit(reader, file)))
+            if len(pending) >= 2 * workers:
+                key, future = pending.popleft()
+                yield key, future.result()
+        while pending:
+            key, future = pending.popleft()
+            yield key, future.result()
+
+
+def read_image_volumes(path, ends_with="pred.png", no_visit=False):
+    """
+    Reads image files in series (see read_image_series for the naming format), straight into
+    one contiguous volume per visit, ordered by slice number. Skips the per-slice dict entirely.
+    :param no_visit: If the filenames don't have v01, etc.
+    :param ends_with: String ending of filename (before ending) to match
+    :param path: Path to folder containing .bmps
+    :return: Nested dictionary {patient: {visit: 3D Array} }
+    """
+    result = {}
+    folder = pathlib.Path(path)
+    listing = _list_and_parse(str(folder), ends_with, no_visit)
+    if len(listing) < 1:
+        log.error(f"No images (ending in '{ends_with}') found in {folder}!")
+        exit(-1)
+
+    # Bucket the files by visit, so each visit can be decoded into its own volume
+    buckets = {}
+    for file, (patient, visit, slice_id) in listing:
+        buckets.setdefault((patient, visit), []).append((slice_id, file))
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for (patient, visit), slices in buckets.items():
+            slices.sort(key=lambda s: s[0])
+            # Each slice is copied into the volume anyway, so it doesn't need its own writable copy
+            images = executor.map(functools.partial(read_image, writable=False), [file for _, file in slices])
+            # Allocate the volume once from the first slice, then copy each slice into place
+            first = next(images)
+            volume = np.empty((len(slices), *first.shape), dtype=first.dtype)
+            volume[0] = first
+            for i, im in enumerate(images, start=1):
+                volume[i] = im
+            result.setdefault(patient, {})[visit] = volume
 
     return result
 
@@ -208,18 +335,13 @@ def read_cdi_bone_volumes(path, ends_with=".txt"):
             continue
         (_, _, _, patient, visit) = name_split
         patient = int(patient)
-        with open(file) as fp:
-            try:
-                for i, line in enumerate(fp):
-                    if i == 5:
-                        start = int(line)
-                    elif i == 6:
-                        end = int(line)
-                    elif i > 6:
-                        break
-                du.update_nested_dict(result, {patient: {visit: (start, end)}})
-            except (TypeError, ValueError) as e:
-                log.error(f"Error parsing {file}: {e}")
+        try:
+            lines = file.read_text().split('\n', 7)  # Only lines 5 and 6 (start, end) are needed
+            start = int(lines[5])
+            end = int(lines[6])
+            result.setdefault(patient, {})[visit] = (start, end)
+        except (IndexError, TypeError, ValueError) as e:
+            log.error(f"Error parsing {file}: {e}")
 
     return result
 
@@ -236,18 +358,26 @@ def read_dicom_series(path):
     folder = pathlib.Path(path)
     patients = [patient for patient in folder.iterdir() if patient.is_dir()]
 
-    for idx, patient in enumerate(patients):
-        sys.stdout.write(f"\r Reading {idx} of {len(patients)} patients from disk. ({idx / len(patients) * 100: .2f}%)")
-        sys.stdout.flush()
+    # Collect the work first, so the parsing can be spread over processes (it is CPU bound, and holds the GIL)
+    keys = []
+    slices = []
+    for patient in patients:
         patient_key = int(patient.name)
         visits = [visit for visit in patient.iterdir() if visit.is_dir()]
         for visit in visits:
             visit_key = visit.name
-            slices = list(visit.glob('*'))
-            for slc in slices:
-                slice_key = int(slc.name)
-                du.update_nested_dict(result, {patient_key: {visit_key: {slice_key: read_dicom(slc)}}})
-    sys.stdout.write(f"\rRead {len(patients)} files from storage.\r\n")
+            for slc in visit.glob('*'):
+                keys.append((patient_key, visit_key, int(slc.name)))
+                slices.append(slc)
+
+    with ProcessPoolExecutor() as executor:
+        datasets = executor.map(read_dicom, slices, chunksize=32)
+        for idx, ((patient_key, visit_key, slice_key), ds) in enumerate(zip(keys, datasets)):
+            if idx % 100 == 0:
+                sys.stdout.write(f"\r Reading {idx} of {len(slices)} slices from disk. ({idx / len(slices) * 100: .2f}%)")
+                sys.stdout.flush()
+            result.setdefault(patient_key, {}).setdefault(visit_key, {})[slice_key] = ds
+    sys.stdout.write(f"\rRead {len(slices)} files from storage.\r\n")
     sys.stdout.flush()
     return result
 
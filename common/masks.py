@@ -20,7 +20,8 @@ J. Blackadar: As far as I can tell, the files are formatted as:
         "Tibia"...
 """
 
-import typing
+import collections
+import re
 import scipy.ndimage as ndimage
 import numpy as np
 
@@ -54,50 +55,80 @@ class MaskMetadata:
         )
 
 
-class Coordinate:
-    y = 0
-    x1 = 0
-    x2 = 0
-
-    def __str__(self):
-        return str(self.y) + " " + str(self.x1) + "." + str(self.x2)
-
-
 class SliceData:
+    """
+    Coordinates are stored as three parallel arrays, one entry per run: ys[i], from x1s[i] to x2s[i] (inclusive).
+    """
     slice_number = 0
-    coordinates: typing.List[Coordinate] = []
+    ys: np.ndarray = np.empty(0, dtype=np.int32)
+    x1s: np.ndarray = np.empty(0, dtype=np.int32)
+    x2s: np.ndarray = np.empty(0, dtype=np.int32)
 
     def __init__(self):
         self.slice_number = 0
-        self.coordinates = []
+        self.ys = np.empty(0, dtype=np.int32)
+        self.x1s = np.empty(0, dtype=np.int32)
+        self.x2s = np.empty(0, dtype=np.int32)
 
 
 def draw_slice_image(slc: SliceData, meta: MaskMetadata):
+    # Note the (width, height) order: rows are indexed by image_height - y (with the offset of 3 applied when parsing),
+    # which reaches 447 for the (448, 444) masks. Swapping to (height, width) would clip those rows, and would also
+    # change the layout of every mask and bone segmented image already generated, which are overlaid on that shape.
     image_array = np.zeros((meta.image_width, meta.image_height), dtype=np.uint8)
+    _rasterize(image_array, meta.image_height - slc.ys, slc.x1s, slc.x2s)
+    return image_array
 
-    for c in slc.coordinates:
-        for idx in range(c.x1, c.x2 + 1):
-            image_array[meta.image_height - c.y, idx] = 255
 
-    return image_array
+def _rasterize(image_array, rows, x1s, x2s):
+    """
+    Fills runs of pixels (row, x1 to x2 inclusive) with 255, without a Python loop.
+    Every run is expanded into its pixel indices with repeat/cumsum, then written in one fancy-index assignment.
+    :param image_array: Array to draw into, modified in place
+    :param rows: np.ndarray of row index of each run
+    :param x1s: np.ndarray of first column of each run
+    :param x2s: np.ndarray of last column of each run (inclusive)
+    :return: None
+    """
+    lengths = np.maximum(x2s - x1s + 1, 0)
+    # Offset of each pixel within its run: a running count which restarts at the start of every run
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    image_array[np.repeat(rows, lengths), np.repeat(x1s, lengths) + offsets] = 255
 
 
 def fill_mask(image_array):
     """
-    Uses binary closing to fill holes in the mask.
-    :param image_array: Mask data, typically output of draw_slice_image
+    Fills holes in the mask: background regions which can't be reached from the image border.
+    Same result as ndimage.binary_fill_holes, but found by labelling the background once (single pass),
+    rather than by iterated dilation from the border.
+    Also accepts a stack of masks (slice * row * column), filling each slice independently in a single call.
+    :param image_array: Mask data, typically output of draw_slice_image (or a stack of them)
     :return: Closed array, scaled back to 0/255
     """
-    closed = ndimage.binary_fill_holes(image_array).astype(np.uint8)
-    return np.where(closed > 0, 255, closed)
+    structure = ndimage.generate_binary_structure(2, 1)  # The default for 2D masks
+    if image_array.ndim == 3:
+        # Only connect pixels within a slice (middle plane of a 3x3x3 structure), so holes can't cross slices
+        structure = np.stack([np.zeros_like(structure), structure, np.zeros_like(structure)])
+    labels, num_labels = ndimage.label(image_array == 0, structure=structure)
 
+    # Background regions touching a slice border are outside the mask, every other one is a hole
+    outside = np.zeros(num_labels + 1, dtype=bool)
+    for edge in (labels[..., 0, :], labels[..., -1, :], labels[..., :, 0], labels[..., :, -1]):
+        outside[edge] = True
+    outside[0] = False  # Label 0 is the mask itself
 
-def extract_slice_mask(lines: list):
+    # Look the 0/255 output up directly from each pixel's label, in one pass over the image
+    values = np.where(outside, 0, 255).astype(np.uint8)
+    return values[labels]
+
+
+def extract_slice_mask(lines: collections.deque):
+    # Expects lines which are already stripped of whitespace, see common.files.read_masks_from_txt
     slc = SliceData()
     slc.slice_number = -1
 
     try:
-        ln = lines.pop(0).strip()
+        ln = lines.popleft()
         if ln == "Tibia":  # TODO: Read the following data in, then discard it if not necessary
             return None
         slc.slice_number = int(ln)
@@ -106,10 +137,6 @@ def extract_slice_mask(lines: list):
         print(f"Not a Slice Number, returning. Found : {e}")
         return None
 
-    if lines[0] == '{':  # Parsing didn't work right, don't parse this slice
-        print(f"Expected open bracket, returning. Found : {lines[0]}")
-        return None
-
     coordinate_lines = []
     _found_first_bracket = False
     _found_last_bracket = False
@@ -120,10 +147,10 @@ def extract_slice_mask(lines: list):
             break
 
         # Remove line from array
-        line = lines.pop(0)
+        line = lines.popleft()
 
         # Find first line with bracket to start parsing
-        if line.strip() == "{":
+        if line == "{":
             _found_first_bracket = True
             continue
 
@@ -131,54 +158,52 @@ def extract_slice_mask(lines: list):
             continue
 
         # Find last bracket to stop
-        if line.strip() == "}":
+        if line == "}":
             _found_last_bracket = True
             break
 
         # Start parsing coordinates
-        coordinate_lines.append(line.strip())
+        coordinate_lines.append(line)
 
     # Get coordinates from lines
-    for line in coordinate_lines:
-        slc.coordinates.extend(_extract_coordinates(line))
+    slc.ys, slc.x1s, slc.x2s = _extract_coordinates(coordinate_lines)
 
     return slc
 
 
-def _extract_coordinates(line):
-    # Logic:
-    #   1. Extract first number as y
-    #   2. For every pair after first number, create separate coordinate using the same y
-    values = []
-
-    # Get coordinate groups
-    pairs: list = line.split(" ")
-
-    y = int(pairs[0])  # Define y value
-    pairs.remove(pairs[0])
-
-    # Create coordinate from each group
-    for p in pairs:
-        x1, x2 = p.split(".")
-        c = Coordinate()
-        c.y = y - 3  # Offset of 3 is due to uneven mask (448, 444) and zero-based indexing
-        c.x1 = int(x1) - 1  # Zero-based indexing
-        c.x2 = int(x2) - 1  # Zero-based indexing
-        values.append(c)
+_NUMBER = re.compile(r'\d+')
 
-    return values
 
-
-# Gets file metadata
-def extract_mask_metadata(lines: list):
+def _extract_coordinates(lines):
+    # Logic:
+    #   1. Each line is a y value, followed by "x1.x2" pairs, each of which is a separate coordinate using the same y
+    #   2. Pull every number out of the whole block at once, then split them into y, x1, x2 by position
+    pairs_per_line = np.array([line.count(".") for line in lines], dtype=np.intp)
+    numbers = np.array(_NUMBER.findall("\n".join(lines)), dtype=np.int32)
+    if numbers.shape[0] != len(lines) + 2 * pairs_per_line.sum():
+        raise ValueError(f"Malformed coordinate lines: {lines}")
+
+    # Each line is 1 + 2 * pairs numbers long, and starts with its y
+    y_positions = np.cumsum(1 + 2 * pairs_per_line) - (1 + 2 * pairs_per_line)
+    ys = np.repeat(numbers[y_positions], pairs_per_line)
+    xs = np.delete(numbers, y_positions).reshape(-1, 2)
+
+    ys = ys - 3  # Offset of 3 is due to uneven mask (448, 444) and zero-based indexing
+    x1s = xs[:, 0] - 1  # Zero-based indexing
+    x2s = xs[:, 1] - 1  # Zero-based indexing
+    return ys, x1s, x2s
+
+
+# Gets file metadata, from lines which are already stripped of whitespace
+def extract_mask_metadata(lines: collections.deque):
     meta = MaskMetadata()
-    meta.case_name = lines.pop(0).strip()
-    meta.case_prefix = lines.pop(0).strip()
-    meta.direction = lines.pop(0).strip()
-    lines.pop(0).strip()  # Skip this next line (not sure why)
-    meta.image_width = int(lines.pop(0).strip())
-    meta.image_height = int(lines.pop(0).strip())
-    meta.start_slice = int(lines.pop(0).strip())
-    meta.end_slice = int(lines.pop(0).strip())
-    lines.pop(0).strip()  # <- "Femur" line
+    meta.case_name = lines.popleft()
+    meta.case_prefix = lines.popleft()
+    meta.direction = lines.popleft()
+    lines.popleft()  # Skip this next line (not sure why)
+    meta.image_width = int(lines.popleft())
+    meta.image_height = int(lines.popleft())
+    meta.start_slice = int(lines.popleft())
+    meta.end_slice = int(lines.popleft())
+    lines.popleft()  # <- "Femur" line
     return meta
@@ -88,9 +88,9 @@ def main():
                     weights.append((phase['train'], phase['test'], phase['validate']))
                     use_first.append(phase['use_first'])
 
-                patients = split_meta.split_phases(phase_paths, weights, use_first)
+                patients = split_meta.split_phases(phase_paths, weights, use_first, seed=inp.get('seed', 0))
                 split_meta._build_general(inp['meta_baseline'], inp['meta_target'], inp['output_dir'],
-                                          patients, only_v00=inp['only_v00'])
+                                          patients, only_v00=inp['only_v00'], link_mode=inp.get('link_mode', 'copy'))
             except KeyError as e:
                 print(f"JSON missing required info. {e}")
         done()
@@ -101,115 +101,132 @@ def main():
 
 
 def list_prompt(prompt, options, context=None):
-    clear()
-    print(f"> {prompt} <")
-    for idx, option in enumerate(options):
-        print(f" {idx+1}. {option}")
-    print()
-    if context:
-        print(f"* {context} *")
-    selection = input("> ")
-
-    # Try to parse user input
-    try:
-        selection = int(selection.strip())
-    except ValueError:
-        return list_prompt(prompt, options, context=f"'{selection}' is not an integer. Try again.")
-    selection = selection - 1  # User entered one-based index
-    if selection not in range(0, len(options)):
-        return list_prompt(prompt, options, context=f"'{selection + 1}' is not a selection. Try again.")
-
-    clear()
-    return selection
-
-
-def multi_list_prompt(prompt, options, context=None):
-    clear()
-    print(f"> {prompt} <")
-    for idx, option in enumerate(options):
-        print(f" {idx + 1}. {option}")
-    print()
-    if context:
-        print(f"* {context} *")
-    print("Enter multiple selections separated by commas. (e.g. 1, 2, 3)")
-    inp = input("> ")
-
-    selections = inp.split(",")
-    cleaned = []
-
-    # Try to parse user input
-    for s in selections:
+    while True:
+        clear()
+        print(f"> {prompt} <")
+        for idx, option in enumerate(options):
+            print(f" {idx+1}. {option}")
+        print()
+        if context:
+            print(f"* {context} *")
+        selection = input("> ")
+
+        # Try to parse user input
         try:
-            i = int(s.strip())
+            selection = int(selection.strip())
         except ValueError:
-            return multi_list_prompt(prompt, options, context=f"'{s}' is not an integer. Try again.")
-        i -= 1  # User entered one-based index
-        if i not in range(0, len(options)):
-            return multi_list_prompt(prompt, options, context=f"'{i + 1}' is not a selection. Try again.")
-        cleaned.append(i)
+            context = f"'{selection}' is not an integer. Try again."
+            continue
+        selection = selection - 1  # User entered one-based index
+        if selection not in range(0, len(options)):
+            context = f"'{selection + 1}' is not a selection. Try again."
+            continue
 
-    if len(cleaned) < 1:
-        return multi_list_prompt(prompt, options, context=f"Please make a selection.")
+        clear()
+        return selection
 
-    clear()
-    return cleaned
 
+def multi_list_prompt(prompt, options, context=None):
+    while True:
+        clear()
+        print(f"> {prompt} <")
+        for idx, option in enumerate(options):
+            print(f" {idx + 1}. {option}")
+        print()
+        if context:
+            print(f"* {context} *")
+        print("Enter multiple selections separated by commas. (e.g. 1, 2, 3)")
+        inp = input("> ")
+
+        selections = inp.split(",")
+        cleaned = []
+        context = None
+
+        # Try to parse user input
+        for s in selections:
+            try:
+                i = int(s.strip())
+            except ValueError:
+                context = f"'{s}' is not an integer. Try again."
+                break
+            i -= 1  # User entered one-based index
+            if i not in range(0, len(options)):
+                context = f"'{i + 1}' is not a selection. Try again."
+                break
+            cleaned.append(i)
+
+        if context:
+            continue
+        if len(cleaned) < 1:
+            context = f"Please make a selection."
+            continue
+
+        clear()
+        return cleaned
 
-def path_prompt(prompt, check_exists=True, context=None):
-    clear()
-    print(f"> {prompt} <")
-    if context:
-        print(f"* {context} *")
-    path = input("> ")
 
-    # Try to parse user input
-    try:
-        path = pathlib.Path(path)
-    except Exception as e:
-        return path_prompt(prompt, check_exists=check_exists, context=f"Invalid Path: {e}. Try again.")
+def path_prompt(prompt, check_exists=True, context=None):
+    while True:
+        clear()
+        print(f"> {prompt} <")
+        if context:
+            print(f"* {context} *")
+        path = input("> ")
+
+        # Try to parse user input
+        try:
+            path = pathlib.Path(path)
+        except Exception as e:
+            context = f"Invalid Path: {e}. Try again."
+            continue
 
-    if check_exists:
-        if not path.exists():
-            return path_prompt(prompt, check_exists=check_exists, context=f"Path '{path}' does not exist. Try again.")
+        if check_exists:
+            if not path.exists():
+                context = f"Path '{path}' does not exist. Try again."
+                continue
 
-    clear()
-    return path
+        clear()
+        return path
 
 
 def int_prompt(prompt, context=None):
-    clear()
-    print(f"> {prompt} <")
-    print()
-    if context:
-        print(f"* {context} *")
-    x = input("> ")
-
-    # Try to parse user input
-    try:
-        i = int(x.strip())
-    except ValueError:
-        return int_prompt(prompt, context=f"'{x}' is not an integer. Try again.")
+    while True:
+        clear()
+        print(f"> {prompt} <")
+        print()
+        if context:
+            print(f"* {context} *")
+        x = input("> ")
+
+        # Try to parse user input
+        try:
+            i = int(x.strip())
+        except ValueError:
+            context = f"'{x}' is not an integer. Try again."
+            continue
 
-    clear()
-    return i
+        clear()
+        return i
 
 
 def float_prompt(prompt, context=None):
-    clear()
-    print(f"> {prompt} <")
-    print()
-    if context:
-        print(f"* {context} *")
-    x = input("> ")
-
-    # Try to parse user input
-    try:
-        i = float(x.strip())
-    except ValueError:
-        return float_prompt(prompt, context=f"'{x}' is not a float. Try again.")
-
-    clear()
-    return i
+    while True:
+        clear()
+        print(f"> {prompt} <")
+        print()
+        if context:
+            print(f"* {context} *")
+        x = input("> ")
+
+        # Try to parse user input
+        try:
+            i = float(x.strip())
+        except ValueError:
+            context = f"'{x}' is not a float. Try again."
+            continue
+
+        clear()
+        return i
 
 
 def clear():
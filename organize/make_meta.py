@@ -9,74 +9,196 @@ These functions help make the meta directory in each visit folder:
             bone_segmented_images/ : Images, with bone_masks applied
 
 """
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import common.files as files
 import common.masks as masks
+import functools
+import os
 import pathlib
 import sys
 import numpy as np
 
 
-def make_meta_for_patients(path, images=True, bone_segmented_images=True, bml=True, bone=True):
+def make_meta_for_patients(path, images=True, bone_segmented_images=True, bml=True, bone=True, workers=None):
     """
     Function to handle iterating through patients and visits, then generate desired meta folders.
     Will overwrite existing files with updated versions, but will not delete other files in the folders.
+    Patients are independent, so they are processed in parallel across worker processes.
     :param bone_segmented_images: Generate images only in regions marked as bone, by bone masks
     :param bone: bool, Generate bone masks
     :param bml: bool, Generate BML masks
     :param images: bool, Generate png images
     :param path: pathlib.Path or str, Path to the folder containing Patients (Phase3, Phase4, etc)
+    :param workers: int, optional, number of worker processes (defaults to the number of CPUs)
     :return: None
     """
-    context = {}
     folder = pathlib.Path(path)
     patients = [patient for patient in folder.iterdir() if patient.is_dir()]
+    work = functools.partial(_process_patient, images=images, bml=bml, bone=bone,
+                             bone_segmented_images=bone_segmented_images)
 
-    for idx, patient in enumerate(patients):
-        sys.stdout.write(f"\rProcessing {idx} of {len(patients)} patients from {path}. ({idx / len(patients) * 100: .2f}%)\r\n")
-        sys.stdout.flush()
-        context['patient_key'] = int(patient.name)
-        visits = [visit for visit in patient.iterdir() if visit.is_dir()]
-        for visit in visits:
-            context['visit_key'] = visit.name
-
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(work, patient) for patient in patients]
+        for idx, future in enumerate(as_completed(futures)):
             try:
-                if images:
-                    make_meta_images(visit, visit / 'meta' / 'images', context=context)
-                if bml:
-                    make_meta_bml_masks(visit, visit / 'meta' / 'bml_masks', context=context)
-                if bone:
-                    make_meta_bone_masks(visit, visit / 'meta' / 'bone_masks', context=context)
-                if bone_segmented_images:
-                    make_meta_bone_segmented_images(visit, visit / 'meta' / 'bone_segmented_images', context=context)
-            except Exception as e:
-                print(f"Error processing meta for {patient}, {visit}: {e}")
+                future.result()
+            except BaseException:
+                executor.shutdown(cancel_futures=True)  # Don't keep converting the other patients once one has failed
+                raise
+            sys.stdout.write(f"\rProcessed {idx + 1} of {len(patients)} patients from {path}. "
+                             f"({(idx + 1) / len(patients) * 100: .2f}%)")
+            sys.stdout.flush()
 
     sys.stdout.write(f"\rProcessed {len(patients)} patients from {path}.\r\n")
     sys.stdout.flush()
 
 
-def make_meta_images(input_path, output_path, context=None):
+def _process_patient(patient, images=True, bone_segmented_images=True, bml=True, bone=True):
+    """
+    Generates the desired meta folders for every visit of one patient. Runs in a worker process.
+    :param patient: pathlib.Path, Path to the patient folder
+    :param images, bone_segmented_images, bml, bone: bool, Meta folders to generate, see make_meta_for_patients
+    :return: None
+    """
+    visits = [visit for visit in patient.iterdir() if visit.is_dir()]
+    for visit in visits:
+        context = {'patient_key': int(patient.name), 'visit_key': visit.name}
+        try:
+            process_visit(visit, context=context, images=images, bone_segmented_images=bone_segmented_images,
+                          bml=bml, bone=bone)
+        except Exception as e:
+            print(f"Error processing meta for {patient}, {visit}: {e}")
+
+
+def process_visit(visit, context=None, images=True, bone_segmented_images=True, bml=True, bone=True):
+    """
+    Generates the desired meta folders for one visit.
+    Each DICOM and txt file is read only once, and shared by every meta folder that needs it.
+    :param visit: pathlib.Path or str, Path to the visit folder
+    :param context: dict, keys 'patient_key' and 'visit_key' to use in output filename
+    :param images, bone_segmented_images, bml, bone: bool, Meta folders to generate, see make_meta_for_patients
+    :return: None
+    """
+    visit = pathlib.Path(visit)
+    meta = visit / 'meta'
+
+    # Images and bone segmented images are both made from the DICOMs
+    dicoms = _read_dicoms(visit) if images and bone_segmented_images else None
+    if images:
+        make_meta_images(visit, meta / 'images', context=context, dicoms=dicoms)
+
+    if bml:
+        make_meta_bml_masks(visit, meta / 'bml_masks', context=context)
+
+    # Bone masks and bone segmented images both use the filled bone masks
+    if bone or bone_segmented_images:
+        bone_text = _find_mask_file(visit, '*FemurBone.txt', 'Bone')
+        if bone_text is None:
+            return
+        bone_slices = _fill_holes(files.read_masks_from_txt(bone_text))
+        if bone:
+            make_meta_bone_masks(visit, meta / 'bone_masks', fill_holes=False, context=context, slices=bone_slices)
+        if bone_segmented_images:
+            make_meta_bone_segmented_images(visit, meta / 'bone_segmented_images', fill_holes=False,
+                                            context=context, dicoms=dicoms, bone_mask_slices=bone_slices)
+
+
+def _find_mask_file(input_path, pattern, label):
+    """
+    Finds the txt mask file matching pattern in input_path, reporting if there is not exactly one.
+    :param input_path: pathlib.Path, path to folder containing input txt file
+    :param pattern: str, glob pattern of the mask file, ex. 'BML*.txt'
+    :param label: str, name of the mask for the printout, ex. 'BML'
+    :return: pathlib.Path of the first match, or None if there is none
+    """
+    # Stop at the first match (and a second, only to warn about it) rather than collecting every match
+    mask_files = input_path.glob(pattern)
+    mask_file = next(mask_files, None)
+    if mask_file is None:
+        print(f"{input_path} has no files matching {label} pattern.")
+        return None
+    duplicate = next(mask_files, None)
+    if duplicate is not None:
+        print(f"{input_path} has multiple files matching {label} pattern: {mask_file}, {duplicate}, ...")
+    return mask_file
+
+
+def _fill_holes(slices):
+    """
+    Fills the holes in every mask of a visit, with one call over the stacked slices.
+    :param slices: dict, {slice_number: mask array}, typically output of files.read_masks_from_txt
+    :return: dict, {slice_number: filled mask array}
+    """
+    if len(slices) == 0:
+        return slices
+    filled = masks.fill_mask(np.stack(list(slices.values())))
+    return dict(zip(slices.keys(), filled))
+
+
+def _read_dicoms(input_path):
+    """
+    Reads every DICOM slice in a visit folder, so it can be shared between the meta generators.
+    :param input_path: pathlib.Path or str, path to folder containing input DICOMs
+    :return: dict, {slice_number: pydicom Dataset}
+    """
+    slices = _list_slices(input_path)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        datasets = executor.map(files.read_dicom, slices.values())
+        return dict(zip(slices.keys(), datasets))
+
+
+def _list_slices(input_path):
+    """
+    Lists the DICOM slice files in a visit folder, which are the files named by their slice number.
+    Anything else (ex. the txt masks, or a stray file) is skipped.
+    os.scandir gets the file type along with the directory listing, so no stat() is needed per file.
+    :param input_path: pathlib.Path or str, path to folder containing input DICOMs
+    :return: dict, {slice_number: path}
+    """
+    slices = {}
+    with os.scandir(input_path) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            try:
+                slc_num = int(entry.name)
+            except ValueError as e:  # Not a numbered DICOM slice
+                continue
+            slices[slc_num] = entry.path
+    return slices
+
+
+def make_meta_images(input_path, output_path, context=None, dicoms=None):
     """
     Creates images from DICOMS at input_path, puts output images at output_path.
     :param context: dict, keys 'patient_key' and 'visit_key' to use in output filename
     :param input_path: pathlib.Path or str, path to folder containing input DICOMs
     :param output_path: pathlib.Path or str, path to folder to contain output .pngs
+    :param dicoms: dict, optional, {slice_number: pydicom Dataset} already read from input_path
     :return: None
     """
     input_path = pathlib.Path(input_path)
     output_path = pathlib.Path(output_path)
     output_path.mkdir(exist_ok=True, parents=True)
-    slices = list(input_path.glob('*[!.txt]'))
     if context:
         patient = context['patient_key']
         visit = context['visit_key']
     else:
         patient = 'x'
         visit = 'vxx'
-    for slc in slices:
-        if not slc.is_dir():
-            slc_num = int(slc.name)
-            files.write_image(files.read_dicom(slc), output_path=output_path / f'{patient}_{visit}_{slc_num}.bmp')
+    if dicoms is None:
+        sources = _list_slices(input_path)
+    else:
+        sources = dicoms
+
+    def convert(job):
+        slc_num, source = job
+        dataset = source if dicoms is not None else files.read_dicom(source)
+        files.write_image(dataset, output_path=output_path / f'{patient}_{visit}_{slc_num}.bmp')
+
+    # Reading and writing is mostly I/O, so overlap it across slices with threads (list() re-raises any errors)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(convert, sources.items()))
 
 
 def make_meta_bml_masks(input_path, output_path, fill_holes=False, context=None):
@@ -99,23 +221,16 @@ def make_meta_bml_masks(input_path, output_path, fill_holes=False, context=None)
         visit = 'vxx'
 
     # Find the BML mask file:
-    bml_files = list(input_path.glob('BML*.txt'))
-    if len(bml_files) > 1:
-        print(f"{input_path} has {len(bml_files)} files matching BML pattern: {bml_files}")
-    elif len(bml_files) == 0:
-        print(f"{input_path} has no files matching BML pattern.")
+    bml_text = _find_mask_file(input_path, 'BML*.txt', 'BML')
+    if bml_text is None:
         return
-    bml_text = bml_files[0]
 
     # Parse the BML file
     slices = files.read_masks_from_txt(bml_text)
 
     # If desired, fill in the holes in the masks
     if fill_holes:
-        new_slices = {}
-        for k, v in slices.items():
-            new_slices[k] = masks.fill_mask(v)  # Makes one continuous region, atypical for BML but here just in case
-        slices = new_slices
+        slices = _fill_holes(slices)  # Makes one continuous region, atypical for BML but here just in case
 
     # Write a mask for each slice
     # TODO: Write blank mask if data exists but not BML?
@@ -123,13 +238,14 @@ def make_meta_bml_masks(input_path, output_path, fill_holes=False, context=None)
         files.write_mask(slc, output_path/f'{patient}_{visit}_{slc_num}_mask.bmp')
 
 
-def make_meta_bone_masks(input_path, output_path, fill_holes=True, context=None):
+def make_meta_bone_masks(input_path, output_path, fill_holes=True, context=None, slices=None):
     """
     Creates masks from Bone txt at input_path, puts output masks at output_path.
     :param fill_holes: Use Binary Closure to Fill Mask Holes
     :param context: dict, keys 'patient_key' and 'visit_key' to use in output filename
     :param input_path: pathlib.Path or str, path to folder containing input txt file
     :param output_path: pathlib.Path or str, path to folder to contain output .png masks
+    :param slices: dict, optional, {slice_number: mask array} already parsed from the Bone txt file
     :return: None
     """
     input_path = pathlib.Path(input_path)
@@ -142,31 +258,24 @@ def make_meta_bone_masks(input_path, output_path, fill_holes=True, context=None)
         patient = 'x'
         visit = 'vxx'
 
-    # Find the Bone mask file:
-    bone_files = list(input_path.glob('*FemurBone.txt'))
-    if len(bone_files) > 1:
-        print(f"{input_path} has {len(bone_files)} files matching Bone pattern: {bone_files}")
-    elif len(bone_files) == 0:
-        print(f"{input_path} has no files matching Bone pattern.")
-        return
-    bone_text = bone_files[0]
-
-    # Parse the Bone file
-    slices = files.read_masks_from_txt(bone_text)
+    # Find and parse the Bone mask file, unless it was already parsed
+    if slices is None:
+        bone_text = _find_mask_file(input_path, '*FemurBone.txt', 'Bone')
+        if bone_text is None:
+            return
+        slices = files.read_masks_from_txt(bone_text)
 
     # If desired, fill in the holes in the masks
     if fill_holes:
-        new_slices = {}
-        for k, v in slices.items():
-            new_slices[k] = masks.fill_mask(v)  # Makes one continuous region, for the bone label
-        slices = new_slices
+        slices = _fill_holes(slices)  # Makes one continuous region, for the bone label
 
     # Write a mask for each slice
     for slc_num, slc in slices.items():
         files.write_mask(slc, output_path / f'{patient}_{visit}_{slc_num}_mask.bmp')
 
 
-def make_meta_bone_segmented_images(input_path, output_path, fill_holes=True, context=None):
+def make_meta_bone_segmented_images(input_path, output_path, fill_holes=True, context=None, dicoms=None,
+                                    bone_mask_slices=None):
     """
     Generates images with only bone region, using DICOMs and txt masks in the input_path.
     Outputs images to output_path.
@@ -174,31 +283,24 @@ def make_meta_bone_segmented_images(input_path, output_path, fill_holes=True, co
     :param context:
     :param input_path:
     :param output_path:
+    :param dicoms: dict, optional, {slice_number: pydicom Dataset} already read from input_path
+    :param bone_mask_slices: dict, optional, {slice_number: mask array} already parsed from the Bone txt file
     :return:
     """
     input_path = pathlib.Path(input_path)
     output_path = pathlib.Path(output_path)
     output_path.mkdir(exist_ok=True, parents=True)
-    image_slices = list(input_path.glob('*[!.txt]'))
-
-    # Find the Bone mask file:
-    bone_files = list(input_path.glob('*FemurBone.txt'))
-    if len(bone_files) > 1:
-        print(f"{input_path} has {len(bone_files)} files matching Bone pattern: {bone_files}")
-    elif len(bone_files) == 0:
-        print(f"{input_path} has no files matching Bone pattern.")
-        return
-    bone_text = bone_files[0]
 
-    # Parse the Bone file
-    bone_mask_slices = files.read_masks_from_txt(bone_text)
+    # Find and parse the Bone mask file, unless it was already parsed
+    if bone_mask_slices is None:
+        bone_text = _find_mask_file(input_path, '*FemurBone.txt', 'Bone')
+        if bone_text is None:
+            return
+        bone_mask_slices = files.read_masks_from_txt(bone_text)
 
     # If desired, fill in the holes in the masks
     if fill_holes:
-        new_slices = {}
-        for k, v in bone_mask_slices.items():
-            new_slices[k] = masks.fill_mask(v)  # Makes one continuous region, for the bone label
-        bone_mask_slices = new_slices
+        bone_mask_slices = _fill_holes(bone_mask_slices)  # Makes one continuous region, for the bone label
 
     if context:
         patient = context['patient_key']
@@ -207,15 +309,27 @@ def make_meta_bone_segmented_images(input_path, output_path, fill_holes=True, co
         patient = 'x'
         visit = 'vxx'
 
-    for slc in image_slices:
-        if not slc.is_dir():
-            try:
-                slc_num = int(slc.name)
-            except TypeError as e:
-                continue
-            if slc_num in bone_mask_slices.keys():
-                # We need the image and mask the same size - (448, 448)
-                im = np.pad(files.read_dicom(slc).pixel_array, [(0, 4), (0, 0)])  # Images are (444, 448)
-                mask = np.pad(bone_mask_slices[slc_num].astype(bool), [(0, 0), (0, 4)])  # Masks are (448, 444)
-                im[~mask] = 0  # This applies the mask to the image - setting all positions without mask to zero
-                files.write_image(im, output_path=output_path / f'{patient}_{visit}_{slc_num}.bmp')
+    # We need the image and mask the same size - (448, 448). Images are (444, 448) and masks are (448, 444),
+    # so only their (444, 444) intersection can hold bone; everything outside of it is zero in the output.
+    im = None  # Allocated on the first slice, to match the DICOM pixel dtype. Reused for every slice.
+    mask = None
+
+    # Only the slices which have a bone mask are needed
+    if dicoms is None:
+        sources = {slc_num: path for slc_num, path in _list_slices(input_path).items() if slc_num in bone_mask_slices}
+    else:
+        sources = {slc_num: dataset for slc_num, dataset in dicoms.items() if slc_num in bone_mask_slices}
+
+    for slc_num, source in sources.items():
+        dataset = source if dicoms is not None else files.read_dicom(source)
+        pixels = dataset.pixel_array
+        bone_mask = bone_mask_slices[slc_num]
+        h = min(pixels.shape[0], bone_mask.shape[0], 448)
+        w = min(pixels.shape[1], bone_mask.shape[1], 448)
+        if im is None or im.dtype != pixels.dtype or mask.shape != (h, w):
+            im = np.zeros((448, 448), dtype=pixels.dtype)
+            mask = np.empty((h, w), dtype=bool)
+        np.not_equal(bone_mask[:h, :w], 0, out=mask)
+        # This applies the mask to the image - setting all positions without mask to zero
+        np.multiply(pixels[:h, :w], mask, out=im[:h, :w])
+        files.write_image(im, output_path=output_path / f'{patient}_{visit}_{slc_num}.bmp')
@@ -3,19 +3,39 @@ Splits meta sub-directories into train, test, and validate.
 Functions for each model, as well as a general function that you can modify for new meta folders if you'd like.
 See make_meta.py for how these directories were made.
 """
+from concurrent.futures import ThreadPoolExecutor
 import math
+import os
 import pathlib
 import shutil
 import json
 import datetime
 import sys
+import numpy as np
 
+try:
+    import orjson  # Optional, much faster JSON encoding (straight to bytes)
+except ImportError:
+    orjson = None
 
-def split_patients(path, train=0.7, test=0.15, validate=0.15, use_first=None):
+try:
+    import fcntl  # Only on Unix, used to reflink files
+except ImportError:
+    fcntl = None
+
+_FICLONE = 0x40049409  # ioctl request to reflink a whole file, from linux/fs.h
+
+# Whether files can be created relative to an open directory (Unix), which skips resolving its path for every file
+_DIR_FDS = {os.open, os.link, os.unlink} <= os.supports_dir_fd
+
+
+def split_patients(path, train=0.7, test=0.15, validate=0.15, use_first=None, seed=0):
     """
     Divide the data into train, test, and validate on the patient level.
     This prevents unfair bias from preview into the test/validate sets.
-    :param use_first: int optional, only use the first use_first number of patients in this path.
+    Patients are shuffled with a seeded RNG, so the split is random but reproducible on any filesystem.
+    :param use_first: int optional, only use the first use_first number of patients (by name) in this path.
+    :param seed: int, seed for the shuffle of the patients
     :param path: path-like to the directory containing patient directories
     :param train: float 0.0 - 1.0 amount of total data to allocate to training
     :param test: float 0.0 - 1.0 amount of total data to allocate to testing
@@ -29,10 +49,12 @@ def split_patients(path, train=0.7, test=0.15, validate=0.15, use_first=None):
             'validate': [],
     }
 
-    folder = pathlib.Path(path)
-    patients = [patient for patient in folder.iterdir() if patient.is_dir()]
+    with os.scandir(path) as entries:
+        patients = sorted(pathlib.Path(entry.path) for entry in entries if entry.is_dir(follow_symlinks=False))
     if use_first is not None:
         patients = patients[0:use_first]
+    # The listing order depends on the filesystem, so sort (above) and then shuffle deterministically
+    patients = [patients[i] for i in np.random.default_rng(seed).permutation(len(patients))]
     num_patients = len(patients)
     # Note that the specified percentages might not be exactly possible with the number of patients.
     # So, we'll use floor division on train and test, and give the remainder to validation.
@@ -40,21 +62,19 @@ def split_patients(path, train=0.7, test=0.15, validate=0.15, use_first=None):
     num_test = math.floor(num_patients * test)
     num_validate = num_patients - (num_train + num_test)
 
-    for i in range(0, num_train):
-        result['train'].append(patients.pop(0))
-    for i in range(0, num_test):
-        result['test'].append(patients.pop(0))
-    for i in range(0, num_validate):
-        result['validate'].append(patients.pop(0))
+    result['train'] = patients[:num_train]
+    result['test'] = patients[num_train:num_train + num_test]
+    result['validate'] = patients[num_train + num_test:]
 
-    print(f"Actual Patient Split is train: {num_train} ({num_train/num_patients: 0.2f}) test: {num_test} "
-          f"({num_test/num_patients: 0.2f}) "
-          f"validate: {num_validate} ({num_validate/num_patients: 0.2f}) ")
+    den = num_patients or 1  # Avoid dividing by zero for an empty folder
+    print(f"Actual Patient Split is train: {num_train} ({num_train/den: 0.2f}) test: {num_test} "
+          f"({num_test/den: 0.2f}) "
+          f"validate: {num_validate} ({num_validate/den: 0.2f}) ")
 
     return result
 
 
-def split_phases(paths, weights, use_first=None):
+def split_phases(paths, weights, use_first=None, seed=0):
     """
     Splits PhaseX folders and combines their output into one patient split.
     Caller specifies paths as a list and weights as a list of (train, test, validate) tuples, equal length.
@@ -62,6 +82,7 @@ def split_phases(paths, weights, use_first=None):
                          None signals to use all. Must be equal length.
     :param paths: List of path-likes to folders containing patients
     :param weights: List of (train, test, validate) tuples (each is a 0.0 - 1.0 float), equal in length to paths
+    :param seed: int, seed for the shuffle of the patients in each path
     :return: dict {'train': [...], 'test': [...], 'validate': [...]}
     """
     assert len(paths) == len(weights), "Specify an equal set of weights for each path."
@@ -76,7 +97,7 @@ def split_phases(paths, weights, use_first=None):
         use_first = [None] * len(paths)
 
     for path, (train, test, validate), num in zip(paths, weights, use_first):  # We need to split each directory, and update the results
-        r = split_patients(path, train, test, validate, num)
+        r = split_patients(path, train, test, validate, num, seed=seed)
         result['train'].extend(r['train'])
         result['test'].extend(r['test'])
         result['validate'].extend(r['validate'])
@@ -84,7 +105,110 @@ def split_phases(paths, weights, use_first=None):
     return result
 
 
-def _build_general(baseline_meta, target_meta, out_dir, patients_split, only_v00=True):
+def _dumps(obj):
+    """
+    Encodes obj as compact JSON bytes, with orjson if it is installed, otherwise the standard library json.
+    :param obj: JSON serializable object
+    :return: bytes, UTF-8 JSON
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+
+def _opener(dir_fd):
+    """
+    Makes an opener for open(), which opens paths relative to an open directory.
+    :param dir_fd: int file descriptor of the directory, or None to open paths as usual
+    :return: opener function, or None
+    """
+    if dir_fd is None:
+        return None
+    return lambda path, flags: os.open(path, flags, 0o666, dir_fd=dir_fd)
+
+
+def _unlink(path, dir_fd=None):
+    """
+    Removes path if it exists, so that it is written to as a new file rather than truncated in place.
+    Truncating a hard link (ex. left by an earlier build with link_mode='hardlink') would empty its source, too.
+    :param path: path-like, file to remove
+    :param dir_fd: int, optional, file descriptor of an open directory which path is relative to
+    :return: None
+    """
+    try:
+        os.unlink(path, dir_fd=dir_fd)
+    except FileNotFoundError:
+        pass
+
+
+def _fastcopy(src, dst, dst_dir_fd=None):
+    """
+    Copies the contents of src to dst. Permissions and other metadata are not copied, as they aren't needed.
+    Tries os.copy_file_range first (Linux), which can copy server-side on NFS or reflink on btrfs/XFS.
+    Otherwise, shutil.copyfile uses the platform's zero-copy fast path (sendfile on Linux, fcopyfile on macOS).
+    :param src: path-like, file to copy
+    :param dst: path-like, destination file (replaced by a new file if it exists, so links to it are untouched)
+    :param dst_dir_fd: int, optional, file descriptor of an open directory which dst is relative to
+    :return: None
+    """
+    _unlink(dst, dir_fd=dst_dir_fd)
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb', opener=_opener(dst_dir_fd)) as fdst:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            if remaining <= 0:
+                return
+        except OSError:
+            pass  # Not supported by this kernel or filesystem, fall back to copyfile below
+    if dst_dir_fd is None:
+        shutil.copyfile(src, dst)
+    else:
+        with open(src, 'rb') as fsrc, open(dst, 'wb', opener=_opener(dst_dir_fd)) as fdst:
+            shutil.copyfileobj(fsrc, fdst)
+
+
+def _stage(src, dst, link_mode='copy', dst_dir_fd=None):
+    """
+    Puts the file src at dst, by copying or linking it.
+    Linked files share their data with the meta folders, so modifying one of them modifies the other!
+    :param src: path-like, file to stage
+    :param dst: path-like, destination file (replaced if it exists, never written through, so links to it are untouched)
+    :param link_mode: 'copy', 'hardlink', 'reflink' (copy-on-write clone, ex. btrfs/XFS), or 'auto' to try
+                      a hard link, then a reflink, and copy if neither is possible
+    :param dst_dir_fd: int, optional, file descriptor of an open directory which dst is relative to
+    :return: None
+    """
+    if link_mode in ('hardlink', 'auto'):
+        try:
+            try:
+                os.link(src, dst, dst_dir_fd=dst_dir_fd)
+            except FileExistsError:
+                os.remove(dst, dir_fd=dst_dir_fd)
+                os.link(src, dst, dst_dir_fd=dst_dir_fd)
+            return
+        except OSError:  # Ex. src and dst are on different filesystems
+            if link_mode == 'hardlink':
+                raise
+    if link_mode in ('reflink', 'auto'):
+        try:
+            if fcntl is None:
+                raise OSError("Reflinks are not supported on this platform.")
+            _unlink(dst, dir_fd=dst_dir_fd)  # Never truncate dst in place, it may be a hard link of src
+            with open(src, 'rb') as fsrc, open(dst, 'wb', opener=_opener(dst_dir_fd)) as fdst:
+                fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+            return
+        except OSError:  # Ex. the filesystem doesn't support reflinks
+            if link_mode == 'reflink':
+                raise
+    _fastcopy(src, dst, dst_dir_fd=dst_dir_fd)
+
+
+def _build_general(baseline_meta, target_meta, out_dir, patients_split, only_v00=True, link_mode='copy'):
     """
     Builds a general model dataset, from meta subdirectories and outputs split patients.
     :param baseline_meta: str, Directory in meta, containing model's baseline images
@@ -92,120 +216,167 @@ def _build_general(baseline_meta, target_meta, out_dir, patients_split, only_v00
     :param out_dir: path-like Directory to place train, test, validate folders
     :param patients_split: Dict {'train': [...], 'test': [...], 'validate': [...]} (use split_patients)
     :param only_v00: Only copy data from v00, the first visit
+    :param link_mode: How to put the files in out_dir, 'copy', 'hardlink', 'reflink', or 'auto' (see _stage).
+                      Linking is much faster and takes no space, but the files then share data with the meta folders.
     :return: None
     """
+    assert link_mode in ('copy', 'hardlink', 'reflink', 'auto'), f"Unknown link_mode '{link_mode}'."
     out_dir = pathlib.Path(out_dir)
     train_dir = out_dir/"train"
     test_dir = out_dir/"test"
     val_dir = out_dir/"validate"
-    out_dir.mkdir(exist_ok=True, parents=True)
     train_dir.mkdir(exist_ok=True, parents=True)
     test_dir.mkdir(exist_ok=True, parents=True)
     val_dir.mkdir(exist_ok=True, parents=True)
-    tracker = {
-            'info': {  # This stores JSON info about the operation
-                    'baseline_meta': str(baseline_meta),
-                    'target_meta': str(target_meta),
-                    'output_dir': str(out_dir),
-                    'only_v00': only_v00,
-                    'num_train_patients': len(patients_split['train']),
-                    'num_test_patients': len(patients_split['test']),
-                    'num_validate_patients': len(patients_split['validate']),
-                    'timestamp': str(datetime.datetime.now())
-            },  # Next, we'll store the data in levels by train/test/split, then patient ID, then visit, then slices.
-            'train': {},
-            'test': {},
-            'validate': {},
+    info = {  # This stores JSON info about the operation
+            'baseline_meta': str(baseline_meta),
+            'target_meta': str(target_meta),
+            'output_dir': str(out_dir),
+            'only_v00': only_v00,
+            'num_train_patients': len(patients_split['train']),
+            'num_test_patients': len(patients_split['test']),
+            'num_validate_patients': len(patients_split['validate']),
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
     }
+    # After the info, the JSON stores the data in levels by train/test/split, then patient ID, then visit, then slices.
+    # It is streamed to the file one patient at a time, rather than kept in memory for the whole dataset.
 
-    def work(iterable, out_dir, tracker):
+    def work(split, iterable, out_dir, js):
+        js.write(b'    ' + _dumps(split) + b': {')
+        out_s = os.fspath(out_dir)  # Paths are joined as plain strings, which is much cheaper than pathlib
+        copies = []  # (source, destination name) of every file to copy, which are copied together once all are found
+        report_every = max(1, len(iterable) // 100)  # Only update the progress line about once per percent
         for idx, p in enumerate(iterable):
-            sys.stdout.write(
-                f"\rBuilding {idx} of {len(iterable)} patients in {out_dir}. ({idx / len(iterable) * 100: .2f}%)")
-            sys.stdout.flush()
-            tracker[p.name] = {}
-            visits = [p/'v00', ] if only_v00 else [visit for visit in p.iterdir() if visit.is_dir()]
+            if idx % report_every == 0:
+                sys.stdout.write(
+                    f"\rBuilding {idx} of {len(iterable)} patients in {out_dir}. ({idx / len(iterable) * 100: .2f}%)")
+                sys.stdout.flush()
+            tracker = {}  # This patient's visits
+            if only_v00:
+                visits = [p/'v00', ]
+            else:
+                with os.scandir(p) as entries:
+                    visits = [pathlib.Path(entry.path) for entry in entries if entry.is_dir(follow_symlinks=False)]
             for v in visits:
                 # Set up the JSON data for this visit
-                tracker[p.name][v.name] = {
+                tracker[v.name] = {
                         'baselines': [],
                         'targets': [],
                 }
-                # Establish the relative directories, and make sure they were built correctly
+                # Establish the relative directories. Listing them below checks they were built correctly
                 meta = v/'meta'
                 b_meta = meta/baseline_meta
                 t_meta = meta/target_meta
-                assert meta.exists(), f"{v} does not contain a meta directory."
-                assert b_meta.exists(), f"{v} does not contain a baseline '{baseline_meta}' meta directory."
-                assert t_meta.exists(), f"{v} does not contain a target '{target_meta}' meta directory."
 
                 # Build lists of all available images for this visit
-                t_imgs = []  # Stores names of target images, with _mask
-                b_imgs = []  # Stores baseline image names
-                for t_img in t_meta.iterdir():  # Find all target images
-                    if t_img.is_file():
-                        assert '_mask' in t_img.name, "Target must have '_mask' in the name, otherwise the files " \
-                                                      "cannot be associated with the baseline."
-                        t_imgs.append(t_img.name)
-                for b_img in b_meta.iterdir():  # Find all baseline images
-                    if b_img.is_file():
-                        b_imgs.append(b_img.name)
-
-                # Now, we need to know the pairs of masks and images. Python set is a convenient way to do that:
-                intersection = set([t.replace('_mask', '') for t in t_imgs]) & set(b_imgs)
-                # Since we need the original filenames, not the ones modified in the set, we need two more O(n) calls...
-                b_imgs = [b for b in b_imgs if b in intersection]
-                t_imgs = [t for t in t_imgs if t.replace('_mask', '') in intersection]
-
-                # Finally, an O(n) call to actually copy the pared down lists, which can now be zipped in equal len
-                for (b_img, t_img) in zip(b_imgs, t_imgs):
-                    shutil.copy(t_meta / t_img, out_dir / t_img)
-                    shutil.copy(b_meta / b_img, out_dir / b_img)
-
-                tracker[p.name][v.name]['baselines'] = b_imgs
-                tracker[p.name][v.name]['targets'] = t_imgs
+                try:
+                    with os.scandir(t_meta) as entries:  # Find all target images
+                        t_imgs = [entry.name for entry in entries if entry.is_file(follow_symlinks=False)]
+                except FileNotFoundError as e:
+                    raise FileNotFoundError(f"{v} does not contain a target '{target_meta}' meta directory.") from e
+                try:
+                    with os.scandir(b_meta) as entries:  # Find all baseline images
+                        b_imgs = [entry.name for entry in entries if entry.is_file(follow_symlinks=False)]
+                except FileNotFoundError as e:
+                    raise FileNotFoundError(f"{v} does not contain a baseline '{baseline_meta}' meta directory.") from e
+                assert all('_mask' in t for t in t_imgs), "Target must have '_mask' in the name, otherwise the files " \
+                                                          "cannot be associated with the baseline."
 
-        sys.stdout.write(f"\rBuilt {len(iterable)} of {len(iterable)} patients in {out_dir}. ({100: .2f}%)\r\n")
+                # Now, we need to know the pairs of masks and images. Python set is a convenient way to do that,
+                # keeping each target's original filename by its baseline name:
+                targets = {t.replace('_mask', ''): t for t in t_imgs}
+                intersection = sorted(targets.keys() & set(b_imgs))  # Sorted, for a deterministic order
+
+                # Finally, an O(n) call to queue each pair for copying, and track them
+                t_meta_s = os.fspath(t_meta)
+                b_meta_s = os.fspath(b_meta)
+                for b_img in intersection:
+                    t_img = targets[b_img]
+                    copies.append((os.path.join(t_meta_s, t_img), t_img))
+                    copies.append((os.path.join(b_meta_s, b_img), b_img))
+                    tracker[v.name]['baselines'].append(b_img)
+                    tracker[v.name]['targets'].append(t_img)
+
+            js.write((b',' if idx else b'') + b'\n        ' + _dumps(p.name) + b': ' + _dumps(tracker))
+
+        js.write(b'\n    }' if iterable else b'}')
+
+        # Copies are I/O bound and independent, so overlap them with threads
+        sys.stdout.write(f"\rCopying {len(copies)} files to {out_dir}.")
         sys.stdout.flush()
+        # Where possible, create the files relative to the open out_dir, rather than resolving its path every time
+        out_fd = os.open(out_s, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0)) if _DIR_FDS else None
+        try:
+            def stage(copy):
+                src, name = copy
+                if out_fd is None:
+                    _stage(src, os.path.join(out_s, name), link_mode=link_mode)
+                else:
+                    _stage(src, name, link_mode=link_mode, dst_dir_fd=out_fd)
+
+            with ThreadPoolExecutor(max_workers=(os.cpu_count() or 1) * 4) as executor:
+                try:
+                    list(executor.map(stage, copies))
+                except BaseException:
+                    executor.shutdown(cancel_futures=True)  # Don't keep staging the queued files once one has failed
+                    raise
+        finally:
+            if out_fd is not None:
+                os.close(out_fd)
 
-    work(patients_split['train'], train_dir, tracker['train'])
-    work(patients_split['test'], test_dir, tracker['test'])
-    work(patients_split['validate'], val_dir, tracker['validate'])
+        sys.stdout.write(f"\rBuilt {len(iterable)} of {len(iterable)} patients in {out_dir}. ({100: .2f}%)\r\n")
+        sys.stdout.flush()
 
-    # Write the JSON file with the info we've been tracking
+    # Write the JSON file with the info we're tracking, as we go. It is streamed to a temporary file, which only
+    # replaces contents.json once every file is in place, so a failed build never leaves a broken contents.json
     json_tracker = out_dir/'contents.json'
-    with json_tracker.open('w') as js:
-        js.write(json.dumps(tracker, indent=4))
+    json_partial = out_dir/'contents.json.tmp'
+    try:
+        with json_partial.open('wb') as js:
+            js.write(b'{\n    "info": ' + _dumps(info) + b',\n')
+            work('train', patients_split['train'], train_dir, js)
+            js.write(b',\n')
+            work('test', patients_split['test'], test_dir, js)
+            js.write(b',\n')
+            work('validate', patients_split['validate'], val_dir, js)
+            js.write(b'\n}\n')
+    except BaseException:
+        _unlink(json_partial)
+        raise
+    os.replace(json_partial, json_tracker)
 
 
-def bone_segmentation(out_dir, patients_split, only_v00=True):
+def bone_segmentation(out_dir, patients_split, only_v00=True, link_mode='copy'):
     """
     Copies data for the Bone Segmentation model into the desired out_dir.
     :param out_dir: path-like Directory to place train, test, validate folders
     :param patients_split: Dict {'train': [...], 'test': [...], 'validate': [...]} (use split_patients)
     :param only_v00: Only copy data from v00, the first visit
+    :param link_mode: 'copy', 'hardlink', 'reflink', or 'auto', see _build_general
     :return: None
     """
-    _build_general('images', 'bone_masks', out_dir, patients_split, only_v00)
+    _build_general('images', 'bone_masks', out_dir, patients_split, only_v00, link_mode)
 
 
-def raw_bml(out_dir, patients_split, only_v00=True):
+def raw_bml(out_dir, patients_split, only_v00=True, link_mode='copy'):
     """
     Copies data for the raw image BML Segmentation model into the desired out_dir.
     :param out_dir: path-like Directory to place train, test, validate folders
     :param patients_split: Dict {'train': [...], 'test': [...], 'validate': [...]} (use split_patients)
     :param only_v00: Only copy data from v00, the first visit
+    :param link_mode: 'copy', 'hardlink', 'reflink', or 'auto', see _build_general
     :return: None
     """
-    _build_general('images', 'bml_masks', out_dir, patients_split, only_v00)
+    _build_general('images', 'bml_masks', out_dir, patients_split, only_v00, link_mode)
 
 
-def bone_segmented_bml(out_dir, patients_split, only_v00=True):
+def bone_segmented_bml(out_dir, patients_split, only_v00=True, link_mode='copy'):
     """
     Copies data for the model which predicts BML from manually segmented bone into the desired out_dir.
     :param out_dir: path-like Directory to place train, test, validate folders
     :param patients_split: Dict {'train': [...], 'test': [...], 'validate': [...]} (use split_patients)
     :param only_v00: Only copy data from v00, the first visit
+    :param link_mode: 'copy', 'hardlink', 'reflink', or 'auto', see _build_general
     :return: None
     """
-    _build_general('bone_segmented_images', 'bml_masks', out_dir, patients_split, only_v00)
+    _build_general('bone_segmented_images', 'bml_masks', out_dir, patients_split, only_v00, link_mode)
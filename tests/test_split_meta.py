@@ -0,0 +1,63 @@
+import os
+import pathlib
+import tempfile
+import unittest
+
+import organize.split_meta as split_meta
+
+
+class TestStage(unittest.TestCase):
+    """
+    Re-staging into an out_dir from an earlier build must never write through to the meta folders.
+    """
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.root = pathlib.Path(self._tmp.name)
+        self.src = self.root/'src.bmp'
+        self.src.write_bytes(b'meta image data')
+        self.out = self.root/'out'
+        self.out.mkdir()
+        self.dst = self.out/'src.bmp'
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def assertSourceIntact(self):
+        self.assertEqual(self.src.read_bytes(), b'meta image data')
+
+    def test_copy_over_hardlink(self):
+        split_meta._stage(self.src, self.dst, 'hardlink')
+        split_meta._stage(self.src, self.dst, 'copy')
+        self.assertSourceIntact()
+        self.assertEqual(self.dst.read_bytes(), b'meta image data')
+        self.assertFalse(os.path.samefile(self.src, self.dst))
+
+    @unittest.skipUnless(split_meta._DIR_FDS, "Files can't be created relative to a directory here.")
+    def test_copy_over_hardlink_dir_fd(self):
+        split_meta._stage(self.src, self.dst, 'hardlink')
+        out_fd = os.open(self.out, os.O_RDONLY)
+        try:
+            split_meta._stage(self.src, self.dst.name, 'copy', dst_dir_fd=out_fd)
+        finally:
+            os.close(out_fd)
+        self.assertSourceIntact()
+        self.assertFalse(os.path.samefile(self.src, self.dst))
+
+    def test_reflink_over_hardlink(self):
+        split_meta._stage(self.src, self.dst, 'hardlink')
+        try:
+            split_meta._stage(self.src, self.dst, 'reflink')
+        except OSError:
+            pass  # This filesystem doesn't support reflinks, the source must survive the attempt regardless
+        self.assertSourceIntact()
+
+    def test_auto_over_copy(self):
+        split_meta._stage(self.src, self.dst, 'copy')
+        split_meta._stage(self.src, self.dst, 'auto')
+        self.assertSourceIntact()
+        self.assertEqual(self.dst.read_bytes(), b'meta image data')
+
+
+if __name__ == '__main__':
+    unittest.main()